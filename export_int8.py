@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Export the bacteria detector to an INT8 TensorRT engine
+
+Calibrates on the images listed in calibration.yaml and writes
+bacteria_detector_final_n.int8.engine, which main.py prefers over the
+FP16 engine when present. Requires a CUDA GPU with INT8 support and
+TensorRT installed.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import yaml
+from ultralytics import YOLO
+
+MODEL_PATH = "bacteria_detector_final_n.pt"
+# Ultralytics names the engine after the checkpoint, so exporting from this
+# copy writes INT8_ENGINE_PATH and leaves main.py's cached FP16 engine alone
+INT8_MODEL_PATH = "bacteria_detector_final_n.int8.pt"
+INT8_ENGINE_PATH = "bacteria_detector_final_n.int8.engine"
+CALIBRATION_DATA = Path(__file__).resolve().parent / "calibration.yaml"
+MIN_CALIBRATION_IMAGES = 100
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif'}
+IMG_SIZE = 640
+MAX_BATCH_SIZE = 8  # must match main.MAX_BATCH_SIZE
+
+def engine_has_int8_layers(engine_path):
+    """Check whether any layer of a TensorRT engine runs in INT8"""
+    import tensorrt as trt
+
+    with open(engine_path, "rb") as f:
+        # Skip the metadata header Ultralytics writes before the engine
+        meta_len = int.from_bytes(f.read(4), byteorder="little")
+        f.seek(meta_len, os.SEEK_CUR)
+        engine_bytes = f.read()
+    
+    runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+    engine = runtime.deserialize_cuda_engine(engine_bytes)
+    info = engine.create_engine_inspector().get_engine_information(
+        trt.LayerInformationFormat.JSON
+    )
+    
+    # Per-layer formats are only recorded with detailed profiling verbosity,
+    # which Ultralytics enables for INT8 builds
+    return any(
+        isinstance(layer, dict) and "int8" in json.dumps(layer.get("Outputs", [])).lower()
+        for layer in json.loads(info)["Layers"]
+    )
+
+def resolve_calibration_data(tmp_dir):
+    """
+    Write a copy of calibration.yaml with an absolute dataset root.
+    
+    Ultralytics resolves relative dataset roots against its own datasets
+    directory, not against the yaml file.
+    
+    Returns:
+        tuple: (path of the resolved yaml, calibration image folder)
+    """
+    with open(CALIBRATION_DATA) as f:
+        data = yaml.safe_load(f)
+    
+    root = (CALIBRATION_DATA.parent / data.get("path", ".")).resolve()
+    data["path"] = str(root)
+    
+    resolved = Path(tmp_dir) / CALIBRATION_DATA.name
+    with open(resolved, "w") as f:
+        yaml.safe_dump(data, f)
+    return str(resolved), root / data["val"]
+
+def export_int8():
+    """Build the INT8 engine at INT8_ENGINE_PATH and verify its precision"""
+    if not os.path.exists(MODEL_PATH):
+        print(f"❌ Model file not found: {MODEL_PATH}")
+        return False
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data, image_dir = resolve_calibration_data(tmp_dir)
+        
+        images = []
+        if image_dir.is_dir():
+            images = [f for f in image_dir.iterdir() if f.suffix.lower() in IMAGE_EXTENSIONS]
+        if not images:
+            print(f"❌ No calibration images found in: {image_dir}")
+            return False
+        if len(images) < MIN_CALIBRATION_IMAGES:
+            print(f"⚠️ Only {len(images)} calibration images; {MIN_CALIBRATION_IMAGES}+ recommended")
+        
+        print(f"⚙️ Calibrating INT8 engine with {len(images)} images from: {image_dir}")
+        shutil.copyfile(MODEL_PATH, INT8_MODEL_PATH)
+        try:
+            engine_path = YOLO(INT8_MODEL_PATH).export(
+                format="engine",
+                int8=True,
+                data=data,
+                device=0,
+                imgsz=IMG_SIZE,
+                dynamic=True,
+                batch=MAX_BATCH_SIZE,
+                workspace=4
+            )
+        finally:
+            os.remove(INT8_MODEL_PATH)
+    
+    # Ultralytics silently drops int8 when the GPU lacks fast INT8 support;
+    # don't leave a non-INT8 engine where main.py would prefer it
+    if not engine_has_int8_layers(engine_path):
+        os.remove(engine_path)
+        print("❌ Exported engine has no INT8 layers; check GPU and Ultralytics version")
+        return False
+    
+    print(f"✅ INT8 engine saved to: {engine_path}")
+    return True
+
+if __name__ == "__main__":
+    sys.exit(0 if export_int8() else 1)
@@ -10,21 +10,38 @@ Version: 1.0.0
 """
 
 from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
+import orjson
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
-import tempfile
+import torch
+from ultralytics.data.augment import LetterBox
+from ultralytics.models.yolo.detect import DetectionPredictor
 from pathlib import Path
 import os
 import sys
+import logging
+import json
+
+# DEV=1 enables auto-reload and verbose logging for local development
+DEV_MODE = os.environ.get("DEV") == "1"
+
+logging.basicConfig(format="%(levelname)s: %(message)s")
+logger = logging.getLogger("bacteria")
+logger.setLevel(logging.INFO if DEV_MODE else logging.WARNING)
 
 # Initialize FastAPI app
 app = FastAPI(
     title="Bacteria Detection API",
     version="1.0.0",
     description="Automated bacteria detection and counting using YOLOv8",
+    default_response_class=ORJSONResponse,
     docs_url="/docs",
     redoc_url="/redoc"
 )
@@ -41,29 +58,284 @@ app.add_middleware(
 # Global model variable
 model = None
 
+MODEL_PATH = "bacteria_detector_final_n.pt"
+ENGINE_PATH = "bacteria_detector_final_n.engine"
+INT8_ENGINE_PATH = "bacteria_detector_final_n.int8.engine"  # built by export_int8.py
+IMG_SIZE = 640
+WARMUP_RUNS = 3
+MAX_BATCH_SIZE = 8
+BATCH_TIMEOUT = 0.005  # seconds to wait for more requests to fill a batch
+
+# Pending (image, future) pairs consumed by the batch worker; created on
+# startup so it binds to the server's event loop
+inference_queue = None
+
+# LRU cache of JSON-encoded detection results keyed by SHA-256 of the
+# upload bytes, bounded by entry count and total encoded size
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_MAX_BYTES = 100 * 1024 * 1024
+result_cache = OrderedDict()
+result_cache_bytes = 0
+
+# Single inference thread keeps GPU calls ordered and off the event loop
+INFER_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+
+class PinnedDetectionPredictor(DetectionPredictor):
+    """DetectionPredictor that stages letterboxed batches in reusable pinned memory"""
+
+    staging = None
+    copy_done = None
+
+    def pre_transform(self, im):
+        # Always pad to the full IMG_SIZE square; Ultralytics' default minimal
+        # rectangles vary per upload and force torch.compile/CUDA-graph/cuDNN
+        # re-specialisation on live requests
+        letterbox = LetterBox(self.imgsz, auto=False, stride=self.model.stride)
+        return [letterbox(image=x) for x in im]
+
+    def preprocess(self, im):
+        if isinstance(im, torch.Tensor) or self.device.type != "cuda":
+            return super().preprocess(im)
+        
+        batch = np.stack(self.pre_transform(im))
+        n, h, w, _ = batch.shape
+        if n <= MAX_BATCH_SIZE and h <= IMG_SIZE and w <= IMG_SIZE:
+            if self.staging is None:
+                self.staging = torch.empty(
+                    (MAX_BATCH_SIZE, IMG_SIZE, IMG_SIZE, 3), dtype=torch.uint8, pin_memory=True
+                )
+                self.copy_done = torch.cuda.Event()
+            else:
+                # Don't overwrite the buffer while the previous copy may be in flight
+                self.copy_done.synchronize()
+            staged = self.staging.view(-1)[:batch.size].view(batch.shape)
+            staged.numpy()[...] = batch
+        else:
+            staged = torch.from_numpy(batch)
+        
+        im = staged.to(self.device, non_blocking=True)
+        if self.copy_done is not None:
+            self.copy_done.record()
+        
+        # BGR HWC -> RGB CHW and normalise on the GPU
+        im = im.flip(-1).permute(0, 3, 1, 2).contiguous()
+        im = im.half() if self.model.fp16 else im.float()
+        return im / 255
+
+def engine_supports_batching(engine_path):
+    """Check an engine was exported with a dynamic batch of at least MAX_BATCH_SIZE"""
+    try:
+        # Ultralytics prefixes the engine with a length-prefixed JSON header
+        with open(engine_path, "rb") as f:
+            meta_len = int.from_bytes(f.read(4), byteorder="little")
+            metadata = json.loads(f.read(meta_len).decode("utf-8"))
+    except (OSError, ValueError):
+        return False
+    dynamic = metadata.get("dynamic", metadata.get("args", {}).get("dynamic"))
+    return metadata.get("batch", 1) >= MAX_BATCH_SIZE and dynamic is not False
+
+def export_engine():
+    """Export the PyTorch checkpoint to an FP16 TensorRT engine if not cached"""
+    from ultralytics import YOLO
+
+    if not os.path.exists(ENGINE_PATH) or not engine_supports_batching(ENGINE_PATH):
+        logger.info("⚙️ Exporting TensorRT engine to: %s", ENGINE_PATH)
+        YOLO(MODEL_PATH).export(
+            format="engine",
+            half=True,
+            device=0,
+            imgsz=IMG_SIZE,
+            dynamic=True,
+            batch=MAX_BATCH_SIZE,
+            simplify=True,
+            workspace=4
+        )
+    return ENGINE_PATH
+
+def setup_predictor():
+    """Attach the pinned-memory predictor so model() calls use it"""
+    # AutoBackend fuses Conv+BN on load; half=True also casts it to FP16 on GPU
+    model.predictor = PinnedDetectionPredictor(
+        overrides={
+            **model.overrides,
+            "mode": "predict",
+            "save": False,
+            "half": torch.cuda.is_available()
+        }
+    )
+    model.predictor.setup_model(model=model.model, verbose=False)
+
+def warm_up(dummy, runs):
+    """Run the model on the inference thread for every micro-batch size"""
+    for batch_size in range(1, MAX_BATCH_SIZE + 1):
+        for _ in range(runs):
+            INFER_EXECUTOR.submit(run_inference, [dummy] * batch_size).result()
+
+def compile_model(dummy):
+    """Compile the eager PyTorch forward with torch.compile, keeping eager on failure"""
+    backend = model.predictor.model
+    eager = backend.model
+    try:
+        backend.model = torch.compile(eager, mode="reduce-overhead", fullgraph=False)
+        warm_up(dummy, 1)
+        logger.info("✅ Model compiled with torch.compile")
+    except Exception as e:
+        backend.model = eager
+        logger.warning("⚠️ torch.compile unavailable, using eager model: %s", e)
+
+def prepare_model():
+    """Attach the predictor, compile the eager model and warm up every batch shape"""
+    setup_predictor()
+    
+    dummy = np.zeros((IMG_SIZE, IMG_SIZE, 3), dtype=np.uint8)
+    if model.predictor.model.pt:
+        compile_model(dummy)
+    
+    # Warm up every batch shape so no request pays CUDA/cuDNN/TensorRT
+    # setup, torch.compile compilation or CUDA-graph recording
+    warm_up(dummy, WARMUP_RUNS)
+
 def load_model():
     """Load the YOLO model with error handling"""
     global model
     try:
         from ultralytics import YOLO
-        MODEL_PATH = "bacteria_detector_final_n.pt"
+        
+        # Let cuDNN benchmark conv algorithms once and reuse the fastest
+        torch.backends.cudnn.benchmark = True
         
         if not os.path.exists(MODEL_PATH):
             raise FileNotFoundError(f"Model file not found: {MODEL_PATH}")
         
-        print(f"Loading model from: {MODEL_PATH}")
-        model = YOLO(MODEL_PATH)
-        print("✅ Model loaded successfully!")
+        model = None
+        if torch.cuda.is_available():
+            try:
+                if os.path.exists(INT8_ENGINE_PATH) and engine_supports_batching(INT8_ENGINE_PATH):
+                    engine_path = INT8_ENGINE_PATH
+                else:
+                    engine_path = export_engine()
+                logger.info("Loading TensorRT engine from: %s", engine_path)
+                model = YOLO(engine_path, task="detect")
+                prepare_model()
+            except Exception as e:
+                model = None
+                logger.warning("⚠️ TensorRT engine unavailable, using PyTorch model: %s", e)
+        
+        if model is None:
+            logger.info("Loading model from: %s", MODEL_PATH)
+            model = YOLO(MODEL_PATH)
+            prepare_model()
+        logger.info("✅ Model loaded successfully!")
         return True
         
     except Exception as e:
-        print(f"❌ Error loading model: {e}")
+        # Don't serve a model that failed setup or warm-up
+        model = None
+        logger.error("❌ Error loading model: %s", e)
         return False
 
+def cache_result(key, detection_json):
+    """Insert encoded detections into the result cache, evicting LRU entries"""
+    global result_cache_bytes
+    previous = result_cache.pop(key, None)
+    if previous is not None:
+        result_cache_bytes -= len(previous)
+    result_cache[key] = detection_json
+    result_cache_bytes += len(detection_json)
+    while len(result_cache) > RESULT_CACHE_SIZE or result_cache_bytes > RESULT_CACHE_MAX_BYTES:
+        _, evicted = result_cache.popitem(last=False)
+        result_cache_bytes -= len(evicted)
+
+def detection_response(detection_json, image_info):
+    """Build the /detect/ response from encoded detections plus image_info"""
+    body = detection_json[:-1] + b',"image_info":' + orjson.dumps(image_info) + b"}"
+    return Response(body, media_type="application/json")
+
+def content_hash(content):
+    """Return the SHA-256 hex digest of uploaded image bytes"""
+    return hashlib.sha256(content).hexdigest()
+
+def decode_image(content):
+    """
+    Decode uploaded image bytes to a BGR ndarray no larger than IMG_SIZE.
+    
+    Returns:
+        tuple: (image or None if undecodable, (x ratio, y ratio) of the resize)
+    """
+    img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None, (1.0, 1.0)
+    
+    # Downscale large images here so YOLO's letterbox only has to pad
+    h, w = img.shape[:2]
+    scale = IMG_SIZE / max(h, w)
+    if scale >= 1:
+        return img, (1.0, 1.0)
+    new_w, new_h = max(1, round(w * scale)), max(1, round(h * scale))
+    resized = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    # Rounding makes the actual ratio differ slightly per axis
+    return resized, (new_w / w, new_h / h)
+
+def run_inference(images):
+    """
+    Run the model without autograd tracking.
+    
+    Returns:
+        list: (boxes as [x1, y1, x2, y2] lists, confidences) per image
+    """
+    with torch.inference_mode():
+        results = model(images, verbose=False, imgsz=IMG_SIZE)
+    
+    # Copy boxes to the host here, in one transfer per array, so the event
+    # loop never waits on the GPU
+    return [
+        (
+            result.boxes.xyxy.cpu().numpy().tolist(),
+            result.boxes.conf.cpu().numpy().tolist()
+        )
+        if result.boxes is not None else ([], [])
+        for result in results
+    ]
+
+async def batch_worker():
+    """Coalesce queued images into batched model calls"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await inference_queue.get()]
+        deadline = loop.time() + BATCH_TIMEOUT
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(inference_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        images = [img for img, _ in batch]
+        try:
+            results = await loop.run_in_executor(INFER_EXECUTOR, run_inference, images)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
 # Try to load model at startup
-print("🔄 Initializing Bacteria Detection API...")
+logger.info("🔄 Initializing Bacteria Detection API...")
 model_loaded = load_model()
 
+@app.on_event("startup")
+async def start_batch_worker():
+    """Start the background task that batches inference requests"""
+    global inference_queue
+    inference_queue = asyncio.Queue()
+    app.state.batch_worker = asyncio.create_task(batch_worker())
+
 @app.get("/")
 def root():
     """
@@ -105,18 +377,17 @@ async def detect_bacteria(file: UploadFile = File(...)):
     Returns:
         JSON response with bacteria count, detections, and metadata
     """
-    tmp_path = None
     try:
         # Check if model is loaded
         if model is None:
-            return JSONResponse(
+            return ORJSONResponse(
                 {"error": "Model not loaded. Please check server logs."}, 
                 status_code=503
             )
         
         # Validate file type
         if not file.filename:
-            return JSONResponse(
+            return ORJSONResponse(
                 {"error": "No filename provided"}, 
                 status_code=400
             )
@@ -124,66 +395,84 @@ async def detect_bacteria(file: UploadFile = File(...)):
         allowed_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif'}
         file_ext = Path(file.filename).suffix.lower()
         if file_ext not in allowed_extensions:
-            return JSONResponse(
+            return ORJSONResponse(
                 {"error": f"Unsupported file type: {file_ext}. Allowed: {allowed_extensions}"}, 
                 status_code=400
             )
         
-        # Save uploaded file to a temporary location
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp:
-            content = await file.read()
-            tmp.write(content)
-            tmp_path = tmp.name
-
-        print(f"🔍 Processing image: {file.filename} ({len(content)} bytes)")
-
-        # Run inference
-        results = model(tmp_path, verbose=False)
-        bacteria_count = 0
-        detections = []
-        
-        for result in results:
-            boxes = result.boxes
-            if boxes is not None:
-                bacteria_count = len(boxes)
-                for i, box in enumerate(boxes):
-                    x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                    conf = box.conf[0].cpu().numpy()
-                    detections.append({
-                        "id": i + 1,
-                        "bbox": [float(x1), float(y1), float(x2), float(y2)],
-                        "confidence": float(conf),
-                        "center_x": float((x1 + x2) / 2),
-                        "center_y": float((y1 + y2) / 2),
-                        "width": float(x2 - x1),
-                        "height": float(y2 - y1)
-                    })
-        
-        print(f"✅ Detection complete: {bacteria_count} bacteria found")
-        
-        return JSONResponse({
-            "bacteria_count": bacteria_count,
-            "detections": detections,
-            "image_info": {
-                "filename": file.filename,
-                "size_bytes": len(content)
+        # Decode the uploaded image in memory, off the event loop, and
+        # release the raw bytes
+        content = await file.read()
+        # Free the upload's spool now rather than at the end of the request
+        await file.close()
+        size_bytes = len(content)
+        image_info = {
+            "filename": file.filename,
+            "size_bytes": size_bytes
+        }
+        
+        # Identical uploads skip decoding and inference entirely; hash off
+        # the event loop since large microscopy images take a while
+        loop = asyncio.get_running_loop()
+        cache_key = await loop.run_in_executor(None, content_hash, content)
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            result_cache.move_to_end(cache_key)
+            logger.info("♻️ Cache hit: %s (%s bytes)", file.filename, size_bytes)
+            return detection_response(cached, image_info)
+        
+        img, (ratio_x, ratio_y) = await loop.run_in_executor(None, decode_image, content)
+        del content
+        if img is None:
+            return ORJSONResponse(
+                {"error": "Could not decode image"}, 
+                status_code=400
+            )
+
+        logger.info("🔍 Processing image: %s (%s bytes)", file.filename, size_bytes)
+
+        # Queue the image for batched inference and wait for its result
+        future = loop.create_future()
+        await inference_queue.put((img, future))
+        xyxy, confs = await future
+        
+        # Map boxes back to original image coordinates
+        if ratio_x != 1.0 or ratio_y != 1.0:
+            xyxy = [
+                [x1 / ratio_x, y1 / ratio_y, x2 / ratio_x, y2 / ratio_y]
+                for x1, y1, x2, y2 in xyxy
+            ]
+        bacteria_count = len(xyxy)
+        detections = [
+            {
+                "id": i + 1,
+                "bbox": bbox,
+                "confidence": conf,
+                "center_x": (bbox[0] + bbox[2]) * 0.5,
+                "center_y": (bbox[1] + bbox[3]) * 0.5,
+                "width": bbox[2] - bbox[0],
+                "height": bbox[3] - bbox[1]
             }
+            for i, (bbox, conf) in enumerate(zip(xyxy, confs))
+        ]
+        
+        logger.info("✅ Detection complete: %s bacteria found", bacteria_count)
+        
+        # Encode once; the same bytes serve this response and later cache hits
+        detection_json = orjson.dumps({
+            "bacteria_count": bacteria_count,
+            "detections": detections
         })
+        cache_result(cache_key, detection_json)
+        
+        return detection_response(detection_json, image_info)
         
     except Exception as e:
-        print(f"❌ Error processing image: {e}")
-        return JSONResponse(
+        logger.error("❌ Error processing image: %s", e)
+        return ORJSONResponse(
             {"error": f"Error processing image: {str(e)}"}, 
             status_code=500
         )
-        
-    finally:
-        # Clean up temp file
-        if tmp_path and os.path.exists(tmp_path):
-            try:
-                Path(tmp_path).unlink(missing_ok=True)
-            except Exception as cleanup_error:
-                print(f"⚠️ Warning: Could not clean up temp file: {cleanup_error}")
 
 if __name__ == "__main__":
     """
@@ -201,10 +490,16 @@ if __name__ == "__main__":
     
     print("-" * 50)
     
+    # reload needs an import string; otherwise serve this module's app so
+    # uvicorn doesn't import main again and load a second copy of the model
     uvicorn.run(
-        "main:app", 
+        "main:app" if DEV_MODE else app, 
         host="0.0.0.0", 
         port=8000, 
-        reload=True,
-        log_level="info"
+        loop="auto",  # uvloop and httptools when installed
+        http="auto",
+        workers=1,  # a single process owns the CUDA context
+        reload=DEV_MODE,
+        log_level="info" if DEV_MODE else "warning",
+        access_log=DEV_MODE
     )